@@ -125,14 +125,23 @@
 
 
 # Import the necessary modules
+import math
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import scipy.stats as sp
+from scipy.stats import qmc as _qmc    # low-discrepancy (Sobol) sampling; aliased to keep the qmc flag name free
+from scipy.special import erfc, ndtr, ndtri    # standard normal tail/CDF functions & inverse CDF
 import pandas as pd
-import matplotlib.pyplot as plt
-# import seaborn as sns  # this module contains plot functionality ... may decide to use later  
+# import seaborn as sns  # this module contains plot functionality ... may decide to use later
+# matplotlib is imported lazily inside Plot_fn, only when a plot is requested
+try:
+    from numba import njit, prange          # optional; accelerates the sampling kernel if installed
+except ImportError:
+    njit = None
+    prange = range                          # uncompiled kernel body falls back to a serial loop
 
 # Functions defined below
-def Plot_fn(file_name,min_x,max_x,incr_x,n,seed='False',
+def Plot_fn(file_name,min_x,max_x,incr_x,n,seed='False',qmc='False',
             ind_plot_by_x='False',ind_plot_by_m='False',
             all_plot_by_x='False',all_plot_by_m='False'):
     '''Generate plots of prepo spend & net marginal savings for each item, 
@@ -140,34 +149,70 @@ def Plot_fn(file_name,min_x,max_x,incr_x,n,seed='False',
     ## Load in the calibration & control parameters
     inputs = pd.read_csv(file_name)
     ## With each of the following insert statements, the parameter value is inserted to the 1st column of the data frame
+    inputs.insert(1,'qmc',qmc,False)
     inputs.insert(1,'seed',seed,False)
     inputs.insert(1,'n',n,False)
     inputs.insert(1,'incr_x',incr_x,False)
     inputs.insert(1,'max_x',max_x,False)
     inputs.insert(1,'min_x',min_x,False)
     #print(inputs.shape)
+    ## matplotlib is only needed when a plot was requested; importing it lazily
+    ## keeps pure-compute runs free of the import (and of any backend requirements)
+    if ind_plot_by_x or ind_plot_by_m or all_plot_by_x or all_plot_by_m:
+        import matplotlib.pyplot as plt
     ## Initialize a data object that will store the summary statistics for all items
     z = []
-    ## Compute & plot the budget & net marginal savings functions for each item
-    for i in range(inputs.shape[0]):
-        ## Compute & store net marginal savings for the item
-        data = MargVal_calc(tuple(inputs.iloc[i][0:]))
-        z.append(data)
+    ## Outer limits of the common margin range; left empty-range unless the
+    ## all-items plot below computes them, which also skips the summary plot
+    min_m,max_m = 0,0
+    ## Materialize the parameter rows once as plain tuples; per-row .iloc access
+    ## would re-dispatch through the pandas indexing machinery for every field
+    rows = list(inputs.itertuples(index=False,name=None))
+    ## Batch the sampling for all items into one Monte Carlo run: the uniforms are
+    ## drawn once and pushed through every item's truncated normal
+    ## a = Phi^-1(Phi(alpha) + u*(Phi(beta)-Phi(alpha))) in a single (item, n)
+    ## broadcast, so all items share the same underlying randomness
+    u,u_q = Draws_gen(int(n),seed,qmc)
+    mean_a = inputs['mean_a'].to_numpy()[:,None]
+    stdev_a = inputs['stdev_a'].to_numpy()[:,None]
+    ndtr_alpha = ndtr((inputs['min_a'].to_numpy()[:,None]-mean_a)/stdev_a)
+    ndtr_beta = ndtr((inputs['max_a'].to_numpy()[:,None]-mean_a)/stdev_a)
+    a_all = ndtri(ndtr_alpha + u*(ndtr_beta-ndtr_alpha))*stdev_a + mean_a
+    ## Indicators for the samples with no local supply (Q = 0, w.p. Q0), per item
+    Q0 = np.clip(inputs['Q0'].to_numpy(),0,1)[:,None]      # Make sure that Q0 is a valid probability
+    q_zero_all = u_q < Q0
+    ## Compute the budget & net marginal savings functions for each item; all
+    ## plotting is deferred until the compute loop has finished so the hot loop
+    ## is not interleaved with matplotlib work. Items are independent once the
+    ## draws are fixed, so spread them across worker processes when there is more
+    ## than one. Workers are forked (never respawned through __main__, which would
+    ## rerun the interactive prompts); where fork is unavailable, run serially.
+    if len(rows) > 1 and 'fork' in mp.get_all_start_methods():
+        workers = min(len(rows),mp.cpu_count())
+        with ProcessPoolExecutor(max_workers=workers,mp_context=mp.get_context('fork'),
+                                 initializer=_Init_worker,initargs=(mp.cpu_count()//workers,)) as pool:
+            z = list(pool.map(MargVal_calc,rows,a_all,q_zero_all))
+    else:
+        for i in range(len(rows)):
+            ## Compute & store net marginal savings for the item
+            z.append(MargVal_calc(rows[i],a_all[i],q_zero_all[i]))
+    ## Create the per-item plots if requested
+    for i in range(len(rows)):
         ## Create a plot by prepo spend for each item if requested
         if ind_plot_by_x:
-            plt.plot(data['x'],data['m'])
+            plt.plot(z[i]['x'],z[i]['m'])
             plt.ylabel('net marginal savings')
             plt.xlabel('prepo spend')
             plt.grid()
-            plt.title(inputs.iloc[i][0])
+            plt.title(rows[i][0])
             plt.show()
         ## Create a plot by net marginal savings for each item if requested
         if ind_plot_by_m:
-            plt.plot(data['m'],data['x'])
+            plt.plot(z[i]['m'],z[i]['x'])
             plt.xlabel('net marginal savings')
             plt.ylabel('prepo spend')
             plt.grid()
-            plt.title(inputs.iloc[i][0])
+            plt.title(rows[i][0])
             plt.show()
     ## Create a plot by prepo spend for all items if requested
     if all_plot_by_x:
@@ -200,22 +245,22 @@ def Plot_fn(file_name,min_x,max_x,incr_x,n,seed='False',
     if min_m < max_m:                       # Only plot sum if there is a common range of m across the items
         ## Store the data in a new data frame to be sorted by m
         z_df = z
-        ## Sort by m & combine all of the m values in the range of [min_m, max_m] for interpolation
+        ## Sort by m & merge the m values of every item as a sorted-unique union
+        ## of plain arrays, instead of concatenating Series and de-duplicating after
         for i in range(len(z_df)):
             z_df[i] = z_df[i].sort_values('m')
             if i == 0:
-                list_m = z_df[i]['m']
+                list_m = z_df[i]['m'].to_numpy()
             else:
-                list_m = pd.concat([list_m,z_df[i]['m']])
-        ## For m_list, drop values out outside of the range, eliminate duplicates
+                list_m = np.union1d(list_m,z_df[i]['m'].to_numpy())
+        ## For m_list, drop values outside of the range (already unique & sorted)
         list_m = list_m[(list_m>=min_m)&(list_m<=max_m)]
-        list_m = list_m.drop_duplicates()
-        ## For each item, interpolate to obtain x values for each m in list_m & add to sum
+        ## For each item, interpolate to obtain x values for each m in list_m &
+        ## accumulate straight into the running sum (one np.interp per item is
+        ## unavoidable, since every item has its own m knots)
+        y = np.zeros(list_m.size)
         for i in range(len(z_df)):
-            if i == 0:
-                y = np.interp(list_m, z_df[i]['m'], z_df[i]['x'])
-            else:
-                y = y + np.interp(list_m, z_df[i]['m'], z_df[i]['x'])
+            y += np.interp(list_m, z_df[i]['m'].to_numpy(), z_df[i]['x'].to_numpy())
         ## Now plot total prepo spend by marginal savings
         plt.plot(list_m,y,'b.')
         plt.xlabel('marginal savings')
@@ -224,80 +269,180 @@ def Plot_fn(file_name,min_x,max_x,incr_x,n,seed='False',
         plt.show()
     return z
 
-def MargVal_calc(params):
-    '''Computes net marginal savings function (per currency unit) over a range of prepo levels for the item'''
+def MargVal_calc(params,a,q_zero):
+    '''Computes net marginal savings function (per currency unit) over a range of prepo
+       levels for the item, given the item's realized cost-ratio draws a and
+       no-local-supply indicators q_zero from the batched Monte Carlo run'''
     ## initialize variables
     min_x = int(params[1])          # Define as integer
     max_x = int(params[2])          # Define as integer
     incr_x = int(params[3])         # Define as integer
-    n = int(params[4])              # Define as integer
-    seed = params[5]
-    m_T = params[6]
-    h = params[7]
-    v = params[8]
-    c = params[9]
-    mean_a = params[10]
-    stdev_a = params[11]
-    min_a = params[12]
-    max_a = params[13]
+    m_T = params[7]
+    h = params[8]
+    v = params[9]
+    c = params[10]
     ## Demand & supply parameters are converted from the item natural unit to currency units of the item
-    m_D = params[14]*c
-    a_D = params[15]*c
-    stdev_D = params[16]*c
-    Q0 = min(max(0,params[17]),1)   # Make sure that Q0 is a valid probability
-    m_Q = params[18]*c
-    a_Q = params[19]*c
-    stdev_Q = params[20]*c
-    rho = params[21]
+    m_D = params[15]*c
+    a_D = params[16]*c
+    stdev_D = params[17]*c
+    m_Q = params[19]*c
+    a_Q = params[20]*c
+    stdev_Q = params[21]*c
+    rho = params[22]
     m_c = h * m_T                   # Compute marginal cost for the item
-    z = []                          # Initialize the data storage object to null
-    for x in range(min_x,max_x+1,incr_x):
-        sample = Sample_gen(x,n,seed,mean_a,stdev_a,min_a,max_a,m_D,a_D,stdev_D,Q0,m_Q,a_Q,stdev_Q,rho)
-        means = sample[['x','P_a','P_D','P_S','P_cx']].mean()
-        m_s = (v-1)*means['P_S'] + means['P_cx'] 
-        m = m_s - m_c
-        z.append([params[0]] + means.tolist() + [m_s,m_c,m])
-        print(f'Item: {params[0]}, x = {x}, marginal savings = {m:.2f}')
-    z = pd.DataFrame(z)
-    z.columns = ['item','x','E[P_a]','E[P_D]','E[P_S]','E[P_cx]','m_s','m_c','m']
+    ## Vector of prepo investment levels at which the functions are evaluated
+    x = np.arange(min_x,max_x+1,incr_x)
+    ## Compute the 4 random variables for all (x, sample) pairs in one broadcast
+    sample = Sample_gen(x,a,q_zero,m_D,a_D,stdev_D,m_Q,a_Q,stdev_Q,rho)
+    ## The expectations at each x are reduced inside Sample_gen's fill pass
+    E_Pa = np.full(x.size,sample['P_a'].mean())
+    E_PD = sample['E_PD']
+    E_PS = sample['E_PS']
+    E_Pcx = sample['E_Pcx']
+    m_s = (v-1)*E_PS + E_Pcx
+    m = m_s - m_c
+    ## Report progress with one buffered write per item instead of a print per x
+    ## point (a single write also keeps lines from different workers together)
+    print('\n'.join(f'Item: {params[0]}, x = {x[j]}, marginal savings = {m[j]:.2f}'
+                    for j in range(x.size)),flush=True)
+    z = pd.DataFrame({'item':params[0],'x':x.astype(float),'E[P_a]':E_Pa,'E[P_D]':E_PD,
+                      'E[P_S]':E_PS,'E[P_cx]':E_Pcx,'m_s':m_s,'m_c':m_c,'m':m})
     return z
 
-def Sample_gen(x,n,seed,mean_a,stdev_a,min_a,max_a,m_D,a_D,stdev_D,Q0,m_Q,a_Q,stdev_Q,rho):
-    '''Generates a sample of size n containing the 4 elements needed to compute marginal
-      savings for a given prepo investment x. A data frame containing the 4 elements is returned.'''
-    ## Initialize random numnber seed if defined
+def _Surv_kernel_py(x,mean_D,stdev_D,mean_Q,stdev_S,q_zero,P_a,P_D,P_S,P_cx,E_D,E_S,E_cx):
+    '''Fills the preallocated (len(x), n) matrices P_D, P_S, P_cx for the (x, sample)
+      grid and accumulates their sample means per x row in the same pass, so the
+      matrices are not re-read for the reduction. Plain-Python body written so that
+      numba can compile it; also runs uncompiled.'''
+    n = mean_D.size
+    inv_D = 1/(stdev_D*math.sqrt(2))
+    inv_S = 1/(stdev_S*math.sqrt(2))
+    for j in prange(x.size):
+        s_d,s_s,s_cx = 0.0,0.0,0.0
+        for i in range(n):
+            p_d = 0.5*math.erfc((x[j]-mean_D[i])*inv_D)
+            if q_zero[i]:                   # no local supply: S = D
+                p_s = p_d
+            else:
+                p_s = 0.5*math.erfc((x[j]-(mean_D[i]-mean_Q[i]))*inv_S)
+            p_cx = P_a[i]*(p_d-p_s)
+            P_D[j,i] = p_d
+            P_S[j,i] = p_s
+            P_cx[j,i] = p_cx
+            s_d += p_d
+            s_s += p_s
+            s_cx += p_cx
+        E_D[j] = s_d/n
+        E_S[j] = s_s/n
+        E_cx[j] = s_cx/n
+    return P_D,P_S,P_cx
+
+## Compile the kernel once at import if numba is available; fastmath lets LLVM
+## reassociate the accumulations and emit SIMD code for the erfc+multiply-add loop,
+## and parallel=True spreads the prange over x rows across the numba thread pool
+_Surv_kernel = njit(cache=True,fastmath=True,parallel=True)(_Surv_kernel_py) if njit else None
+
+def _Init_worker(threads):
+    '''Caps the kernel's thread count inside each pool worker so the process pool
+      and the parallel kernel do not oversubscribe the machine together.'''
+    if njit:
+        import numba
+        numba.set_num_threads(max(1,threads))
+
+## Single module-level random number generator, reused across calls when no fixed seed is requested
+_rng = np.random.default_rng()
+
+## Pool of work arrays for the (len(x), n) matrices, reused across items since every
+## item is evaluated on the same x grid with the same sample size
+_buffers = {}
+
+def _Work_arrays(shape):
+    '''Return the three reusable work matrices for P_D, P_S, P_cx, reallocating
+      only when the requested shape changes.'''
+    if _buffers.get('shape') != shape:
+        _buffers['shape'] = shape
+        ## Single precision: the matrices are Monte Carlo probabilities, so float32
+        ## resolution (~1e-7) is far below the sampling error while halving the
+        ## memory traffic; the per-x means are still accumulated in double
+        _buffers['arrays'] = (np.empty(shape,dtype=np.float32),
+                              np.empty(shape,dtype=np.float32),
+                              np.empty(shape,dtype=np.float32))
+    return _buffers['arrays']
+
+def Draws_gen(n,seed,qmc):
+    '''Draws the n sampling uniforms shared by every item in the batched Monte
+      Carlo run: the cost-ratio uniforms for the truncated-normal inversion and
+      the no-local-supply uniforms for the Bernoulli Q = 0 indicator.'''
+    ## Use a fresh fixed-seed generator if requested, else the shared module-level one
     if seed:
-        np.random.seed(100)                     # Can change the seed value; current at 100
-    ## Initialize object to store the elements of the sample
-    z = []
-    ## Loop to generate the n elements of the sample
-    for i in range(1,n+1):
-        ## Generate random a (local-to-prepo cost ratio) & compute P_a = max{a-1,0}
-        a = sp.truncnorm.rvs((min_a-mean_a)/stdev_a,
-                             (max_a-mean_a)/stdev_a,
-                             mean_a,stdev_a)
-        P_a = max(a-1,0)
-        ## Compute mean demand conditional on a
-        mean_D = m_D + a_D*a
-        ## Compute P_D = P[D > x]
-        P_D = 1-sp.norm.cdf(x,mean_D,stdev_D)
-        ## Compute P_S = P[S > x]; S = D-Q
-        if sp.uniform.rvs() < Q0:      # if true, then Q = 0
-            mean_S,stdev_S = 0,0
-            P_S = P_D
-        else: 
-            mean_Q = m_Q + a_Q*a
-            mean_S = mean_D - mean_Q
-            stdev_S = (stdev_D**2 + stdev_Q**2 - 2*rho*stdev_D*stdev_Q)**0.5
-            P_S = 1-sp.norm.cdf(x,mean_S,stdev_S)
-        ## Compute P_cx =P_a * (P_D - P_S)
-        P_cx = P_a * (P_D - P_S)
-        ## Store the results
-        z.append([x,i,a,P_a,mean_D,P_D,mean_S,stdev_S,P_S,P_cx])
-    ## Convert the data object to a data frame and return
-    z = pd.DataFrame(z)
-    z.columns = ['x','trial','a','P_a','mean_D','P_D','mean_S','stdev_S','P_S','P_cx']
-    return z
+        rng = np.random.default_rng(100)        # Can change the seed value; current at 100
+    else:
+        rng = _rng
+    ## Low-discrepancy (scrambled Sobol) or pseudo-random uniforms for the inversion.
+    ## Sobol points spread more evenly over [0,1), cutting the sample size needed for
+    ## a given accuracy; n a power of 2 preserves their balance properties.
+    if qmc:
+        ## Two Sobol dimensions: the cost-ratio uniforms and the Bernoulli Q = 0
+        ## uniforms, so the no-local-supply frequency is stratified to ~Q0 exactly
+        ## instead of fluctuating with binomial noise
+        U = _qmc.Sobol(2,seed=rng).random(n)
+        return U[:,0],U[:,1]
+    return rng.random(n),rng.random(n)
+
+def Sample_gen(x,a,q_zero,m_D,a_D,stdev_D,m_Q,a_Q,stdev_Q,rho):
+    '''Computes the 4 elements needed for marginal savings at each prepo investment
+      in the vector x, from the item's realized cost-ratio draws a and no-local-supply
+      indicators q_zero. A dict of arrays is returned: per-sample arrays of length n
+      and (len(x), n) matrices for the x-dependent elements.'''
+    n = a.size
+    ## Compute P_a = max{a-1,0} for all samples
+    P_a = np.maximum(a-1,0)
+    ## Compute mean demand conditional on a
+    mean_D = m_D + a_D*a
+    ## Mean local supply conditional on a (given Q > 0)
+    mean_Q = m_Q + a_Q*a
+    ## The correlation between (z_D,z_Q) is folded into stdev_S analytically
+    ## (equivalent to mixing z_Q = rho*z_D + sqrt(1-rho^2)*z_perp), so no
+    ## bivariate normal draws are needed per sample
+    stdev_S = (stdev_D**2 + stdev_Q**2 - 2*rho*stdev_D*stdev_Q)**0.5
+    x = np.asarray(x)
+    ## Fetch the pooled work matrices (one allocation for all items on the same grid)
+    P_D,P_S,P_cx = _Work_arrays((x.size,n))
+    ## Per-x sample means, filled in the same pass as the matrices
+    E_D,E_S,E_cx = np.empty(x.size),np.empty(x.size),np.empty(x.size)
+    if _Surv_kernel is not None:
+        ## Compiled kernel: fused (x, sample) double loop over the survivor functions
+        _Surv_kernel(x,mean_D,stdev_D,mean_Q,stdev_S,q_zero,P_a,P_D,P_S,P_cx,E_D,E_S,E_cx)
+    else:
+        ## NumPy fallback: broadcast x (as a column) against the samples, tiled into
+        ## blocks of x rows so the block of all three matrices (plus temporaries)
+        ## stays cache-resident instead of streaming (len(x), n) through memory 3 times.
+        ## Single-precision copies of the broadcast operands keep the block math
+        ## (and its temporaries) in float32 end to end.
+        xf = x.astype(np.float32)
+        mean_D32 = mean_D.astype(np.float32)
+        mean_S32 = (mean_D-mean_Q).astype(np.float32)
+        P_a32 = P_a.astype(np.float32)
+        blk = max(1,(1<<18)//(4*n))             # ~256 KB of rows per matrix block
+        for j in range(0,x.size,blk):
+            xx = xf[j:j+blk].reshape(-1,1)
+            ## Compute P_D = P[D > x], using the survivor function P[Z > z] = erfc(z/sqrt(2))/2
+            ## directly rather than 1 - norm.cdf (no cancellation, no subtraction pass)
+            P_D[j:j+blk] = 0.5*erfc((xx-mean_D32)/(stdev_D*math.sqrt(2)))
+            ## Compute P_S = P[S > x]; S = D-Q (conditional on Q > 0)
+            P_S[j:j+blk] = 0.5*erfc((xx-mean_S32)/(stdev_S*math.sqrt(2)))
+            ## Where Q = 0, S = D: overwrite those columns in place rather than
+            ## selecting through np.where (which builds a full extra matrix)
+            np.copyto(P_S[j:j+blk],P_D[j:j+blk],where=q_zero)
+            ## Compute P_cx = P_a * (P_D - P_S)
+            P_cx[j:j+blk] = P_a32 * (P_D[j:j+blk] - P_S[j:j+blk])
+            ## Reduce the block to its per-x means while it is still cache-resident
+            E_D[j:j+blk] = P_D[j:j+blk].mean(axis=1)
+            E_S[j:j+blk] = P_S[j:j+blk].mean(axis=1)
+            E_cx[j:j+blk] = P_cx[j:j+blk].mean(axis=1)
+    ## Return the arrays keyed by name
+    return {'a':a,'P_a':P_a,'P_D':P_D,'P_S':P_S,'P_cx':P_cx,
+            'E_PD':E_D,'E_PS':E_S,'E_Pcx':E_cx}
 
 
 # # The code is executed in the next cell.
@@ -314,6 +459,7 @@ def Sample_gen(x,n,seed,mean_a,stdev_a,min_a,max_a,m_D,a_D,stdev_D,Q0,m_Q,a_Q,st
 
 # The following 5 inputs are currently set (no user prompt). This can be changed later is user control viewed as worthwhile
 seed = True                             # True if same seed used for each simulation (default is False); set to 'True' to reduce confounding of results across items
+qmc = True                              # True if low-discrepancy (Sobol) sampling is used for the cost-ratio draw (default is False); cuts sampling noise at a given n
 ind_plot_by_x = False                   # True if plots by spend for each item are created (default is False)
 ind_plot_by_m = False                   # True if plots by marginal savings for each item are created (default is False)
 all_plot_by_x = True                    # True if plot by spend for all items is created (default is False)
@@ -348,12 +494,10 @@ o_file_name = input('Output file name (eg, enter "Results_75a" for output file "
 #print('\n',i_file_name,min_x,max_x,incr_x,n,o_file_name)
 
 # Plot the marginal savings and prepo spend functions for each item
-data = Plot_fn(i_file_name,min_x,max_x,incr_x,n,seed,ind_plot_by_x,ind_plot_by_m,all_plot_by_x,all_plot_by_m)
+data = Plot_fn(i_file_name,min_x,max_x,incr_x,n,seed,qmc,ind_plot_by_x,ind_plot_by_m,all_plot_by_x,all_plot_by_m)
 
 # Consolidate the multidimensional data frame into a single data frame to be written to the user-specified file
-results=data[0]
-for i in range(1,len(data)):
-    results=pd.concat([results,data[i]])
+results=pd.concat(data)
 
 # Write the consolidated data frame to a csv file
 results.to_csv(o_file_name,index=False)